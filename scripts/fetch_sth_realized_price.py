@@ -1,57 +1,264 @@
 import os
-import io
-import json
+import re
+import gzip
+import csv
+import queue
+import threading
+from functools import lru_cache
 from pathlib import Path
 
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import requests
+import zstandard
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Try both, some metrics behave differently across these
+# Try both (raced in parallel when there's no cached copy), some metrics behave differently across these
 URLS_TO_TRY = [
     "https://api.bitcoinmagazinepro.com/v1/metrics/sth-realized-price",
     "https://api.bitcoinmagazinepro.com/metrics/sth-realized-price",
 ]
 
 OUT_PATH = Path("data/sth-realized-price.json")
+OUT_GZ_PATH = Path("data/sth-realized-price.json.gz")
+
+# Last good CSV (zstd-compressed) plus the validators to revalidate it with
+CACHE_PATH = Path("data/.cache/sth.csv.zst")
+CACHE_META_PATH = Path("data/.cache/meta.json")
+
+# One pooled session shared by the raced requests (two connections to the same host);
+# transient errors are retried with backoff inside urllib3, but a read timeout is not
+# retried so a hung endpoint costs one timeout rather than four
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=2,
+        max_retries=Retry(
+            total=3, read=0, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]
+        ),
+    ),
+)
+
+# Accepted header names (lowercased), in order of preference
+DATE_COLS = ("date", "time", "timestamp")
+PRICE_COLS = ("price", "btc_price", "btcprice", "usd_price", "price_usd")
+STH_COLS = (
+    "sth_realized_price",
+    "sthrealizedprice",
+    "sth_realized",
+    "realized_price",
+    "realizedprice",
+    "value",
+)
+
+
+# Literal backslash escapes BMP leaves inside its quoted-string CSV
+_ESCAPES = {b"\\n": b"\n", b"\\r": b"\r"}
+_ESCAPES_RE = re.compile(rb"\\[nr]")
+
+
+def _clean_csv_text(raw: bytes) -> bytes:
+    """
+    BMP sometimes returns CSV as a quoted string with literal '\\n'.
+    Normalize it into real CSV bytes in a single regex pass.
+    """
+    b = (raw or b"").strip()
+    if not b:
+        return b""
+
+    if b[:1] in (b'"', b"'") and b[-1:] == b[:1]:
+        b = b[1:-1]
+
+    b = _ESCAPES_RE.sub(lambda m: _ESCAPES[m.group()], b)
+    return b.strip()
 
 
-def _clean_csv_text(raw: str) -> str:
+def _csv_header(body: bytes) -> list:
     """
-    BMP sometimes returns CSV as a quoted string with literal '\\n'.
-    Normalize it into real CSV text.
+    Column names from the first line of the CSV, read without parsing the body.
+    """
+    first_line = re.match(rb"\s*([^\r\n]*)", body).group(1).decode("utf-8", "replace")
+    return next(csv.reader([first_line]), [])
+
+
+def _pick_cols(columns) -> tuple:
+    """
+    (date, price, sth) column names, matched case-insensitively in alias preference order.
+    """
+    cols_lower = {c.strip().lower(): c for c in columns}
+    return tuple(
+        next((cols_lower[n] for n in candidates if n in cols_lower), None)
+        for candidates in (DATE_COLS, PRICE_COLS, STH_COLS)
+    )
+
+
+def _read_csv(body: bytes, columns) -> pd.DataFrame:
+    """
+    Parse CSV bytes with PyArrow's multithreaded reader, materializing only `columns`.
+    Column types are inferred during the parse; clean numeric columns arrive as float64 already.
+    Plain YYYY-MM-DD dates come back as date32 and datetimes via the timestamp parsers; both land
+    in pandas as datetime64 rather than per-row Python objects. Anything else stays a string.
+    Arrow buffers are released column by column as pandas takes them over, keeping peak memory near one copy.
+    """
+    read_opts = pacsv.ReadOptions(use_threads=True, block_size=1 << 20)
+    parse_opts = pacsv.ParseOptions(delimiter=",")
+    convert_opts = pacsv.ConvertOptions(
+        timestamp_parsers=["%Y-%m-%d", "%Y-%m-%dT%H:%M:%S"],
+        include_columns=columns,
+    )
+    table = pacsv.read_csv(
+        pa.BufferReader(body),
+        read_options=read_opts,
+        parse_options=parse_opts,
+        convert_options=convert_opts,
+    )
+    return table.to_pandas(date_as_object=False, split_blocks=True, self_destruct=True)
+
+
+def _parse_dates(values: pd.Series) -> pd.Series:
+    """
+    Coerce dates to datetime64, trying the fixed %Y-%m-%d format before pandas' per-value inference.
+    Columns the CSV reader already typed (the normal case for BMP data) are returned as-is.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    dates = pd.to_datetime(values, format="%Y-%m-%d", errors="coerce", cache=True)
+    if (dates.isna() & values.notna()).any():
+        dates = pd.to_datetime(values, format="mixed", errors="coerce", cache=True)
+    return dates
+
+
+def _rolling_mean(values: np.ndarray, nan: np.ndarray, window: int) -> tuple:
+    """
+    Trailing mean over `window` values via cumulative sums, given the NaN mask of `values`.
+    Like rolling(window, min_periods=window).mean(): NaN until the window is full or if it contains a NaN.
+    Returns the means and their NaN mask, which falls out of the same cumulative NaN count.
+    """
+    n = len(values)
+    out = np.full(n, np.nan)
+    out_nan = np.ones(n, dtype=bool)
+    if n < window:
+        return out, out_nan
+
+    sums = np.concatenate(([0.0], np.cumsum(np.where(nan, 0.0, values))))
+    nans = np.concatenate(([0], np.cumsum(nan)))
+
+    out_nan[window - 1:] = (nans[window:] - nans[:-window]) > 0
+    out[window - 1:] = (sums[window:] - sums[:-window]) / window
+    out[out_nan] = np.nan
+    return out, out_nan
+
+
+def _nullable(values: np.ndarray, nan: np.ndarray) -> list:
+    """
+    Python floats with the positions in the NaN mask mapped to None.
+    tolist() converts in C; only the masked positions are touched in Python.
+    """
+    out = values.tolist()
+    for i in np.flatnonzero(nan).tolist():
+        out[i] = None
+    return out
+
+
+def _load_cache_meta() -> dict:
+    if not CACHE_PATH.exists():
+        return {}
+    try:
+        return orjson.loads(CACHE_META_PATH.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+
+
+def _save_cache(url: str, resp: requests.Response) -> None:
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return
+
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    CACHE_PATH.write_bytes(zstandard.ZstdCompressor().compress(resp.content))
+    CACHE_META_PATH.write_bytes(
+        orjson.dumps({"url": url, "etag": etag, "last_modified": last_modified})
+    )
+
+
+def _get(url: str, headers: dict, results: queue.Queue) -> None:
+    try:
+        resp = _SESSION.get(url, headers=headers, timeout=60)
+        resp.raise_for_status()
+        results.put((url, resp, None))
+    except Exception as e:
+        results.put((url, None, e))
+
+
+def _first_response(headers_by_url: dict) -> tuple:
     """
-    txt = (raw or "").strip()
-    if not txt:
-        return ""
+    (url, response) from whichever request succeeds first.
+    Requests run on daemon threads, so a slower endpoint never holds up the rest of the job or its exit.
+    """
+    results = queue.Queue()
+    for url, headers in headers_by_url.items():
+        threading.Thread(target=_get, args=(url, headers, results), daemon=True).start()
 
-    if (txt.startswith('"') and txt.endswith('"')) or (txt.startswith("'") and txt.endswith("'")):
-        txt = txt[1:-1]
+    last_err = None
+    for _ in headers_by_url:
+        url, resp, err = results.get()
+        if err is None:
+            return url, resp
+        last_err = err
 
-    txt = txt.replace("\\n", "\n").replace("\\r", "\r")
-    return txt.strip()
+    raise RuntimeError(f"Failed to fetch metric from all endpoints. Last error: {last_err}")
 
 
-def _fetch_csv(api_key: str) -> str:
+def _fetch_csv(api_key: str) -> bytes:
+    """
+    Raw CSV body from BMP.
+    With a cached copy, only its endpoint is asked (conditionally) and a 304 is read from disk;
+    otherwise, or if that request fails, all endpoints are raced and the first answer wins.
+    """
     headers = {
         "Authorization": f"Bearer {api_key}",
         # This is the key change to avoid 406 on CSV-only endpoints
         "Accept": "text/csv, application/csv;q=0.9, */*;q=0.8",
         "User-Agent": "Mozilla/5.0",
     }
-
-    last_err = None
-    for url in URLS_TO_TRY:
+    all_urls = {url: headers for url in URLS_TO_TRY}
+
+    meta = _load_cache_meta()
+    if meta.get("url") in URLS_TO_TRY:
+        req_headers = dict(headers)
+        if meta.get("etag"):
+            req_headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            req_headers["If-Modified-Since"] = meta["last_modified"]
         try:
-            resp = requests.get(url, headers=headers, timeout=60)
-            print("BMP API URL:", url)
-            print("BMP API status code:", resp.status_code)
-            print("Content-Type:", resp.headers.get("Content-Type"))
-            resp.raise_for_status()
-            return resp.text
-        except Exception as e:
-            last_err = e
+            url, resp = _first_response({meta["url"]: req_headers})
+        except RuntimeError as e:
+            print("Revalidating cached CSV failed, trying all endpoints:", e)
+            url, resp = _first_response(all_urls)
+    else:
+        url, resp = _first_response(all_urls)
 
-    raise RuntimeError(f"Failed to fetch metric from all endpoints. Last error: {last_err}")
+    print("BMP API URL:", url)
+    print("BMP API status code:", resp.status_code)
+    print("Content-Type:", resp.headers.get("Content-Type"))
+
+    if resp.status_code == 304:
+        print("Not modified, using cached CSV:", CACHE_PATH)
+        return zstandard.ZstdDecompressor().decompress(CACHE_PATH.read_bytes())
+    _save_cache(url, resp)
+    return resp.content
+
+
+# In-process memo for repeated main() calls (local debugging, CI reruns); opt in with BMP_CACHE=1
+_fetch_csv_cached = lru_cache(maxsize=4)(_fetch_csv)
 
 
 def main():
@@ -59,87 +266,70 @@ def main():
     if not api_key:
         raise RuntimeError("Missing BMP_API_KEY env var. Add it in GitHub Secrets as BMP_API_KEY.")
 
-    raw_text = _fetch_csv(api_key)
-    cleaned = _clean_csv_text(raw_text)
+    fetch = _fetch_csv_cached if os.environ.get("BMP_CACHE") == "1" else _fetch_csv
+    body = fetch(api_key)
+    if body[:64].lstrip()[:1] in (b'"', b"'"):
+        body = _clean_csv_text(body)
 
-    if not cleaned:
+    if not body or body.isspace():
         raise RuntimeError("Empty response from BMP API")
 
-    df = pd.read_csv(io.StringIO(cleaned))
-    if df.empty:
-        print("First 200 characters of response:", cleaned[:200])
-        raise RuntimeError("Parsed empty DataFrame from CSV")
-
-    print("Parsed columns:", list(df.columns))
-
     # Common BMP CSV pattern: first column is unnamed index, then Date, Price, sth_realized_price (or similar)
-    cols_lower = {str(c).strip().lower(): c for c in df.columns}
-
-    def pick(*names):
-        for n in names:
-            if n in cols_lower:
-                return cols_lower[n]
-        return None
-
-    date_col = pick("date", "time", "timestamp")
-    price_col = pick("price", "btc_price", "btcprice", "usd_price", "price_usd")
-    sth_col = pick(
-        "sth_realized_price",
-        "sthrealizedprice",
-        "sth_realized",
-        "realized_price",
-        "realizedprice",
-        "value",
-    )
+    columns = _csv_header(body)
+    print("Parsed columns:", columns)
+
+    date_col, price_col, sth_col = _pick_cols(columns)
 
     if not date_col or not sth_col:
         raise RuntimeError(
             "Could not find required columns.\n"
-            f"Columns found: {list(df.columns)}\n"
+            f"Columns found: {columns}\n"
             f"Picked date={date_col}, price={price_col}, sth={sth_col}"
         )
 
-    # Keep only what we need
+    # Keep only what we need; the other columns are skipped by the parser
     keep = [date_col, sth_col] + ([price_col] if price_col else [])
-    df = df[keep].copy()
-
-    # Parse date and coerce numerics
-    df[date_col] = pd.to_datetime(df[date_col], errors="coerce")
-    df = df.dropna(subset=[date_col]).sort_values(date_col)
-
-    if price_col:
-        df[price_col] = pd.to_numeric(df[price_col], errors="coerce")
-    df[sth_col] = pd.to_numeric(df[sth_col], errors="coerce")
-
-    # 200-day moving average from BTC price (only if price column exists)
-    if price_col:
-        df["ma200"] = df[price_col].rolling(window=200, min_periods=200).mean()
-    else:
-        df["ma200"] = None
-
-    out = []
-    for _, r in df.iterrows():
-        d = r[date_col]
-        if pd.isna(d):
-            continue
-
-        item = {
-            "date": d.strftime("%Y-%m-%d"),
-            "sth_realized": None if pd.isna(r[sth_col]) else float(r[sth_col]),
-            "price": None,
-            "ma200": None,
-        }
-
-        if price_col and pd.notna(r[price_col]):
-            item["price"] = float(r[price_col])
-        if price_col and pd.notna(r["ma200"]):
-            item["ma200"] = float(r["ma200"])
+    df = _read_csv(body, keep)
+    if df.empty:
+        print("First 200 characters of response:", body[:200].decode("utf-8", "replace"))
+        raise RuntimeError("Parsed empty DataFrame from CSV")
 
-        out.append(item)
+    # A stray non-numeric cell makes Arrow fall back to strings; coerce those to NaN like before
+    for c in (price_col, sth_col):
+        if c and not pd.api.types.is_float_dtype(df[c]):
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+
+    # Dates only need coercing if inference fell back to strings
+    days = _parse_dates(df[date_col]).to_numpy(dtype="datetime64[D]")
+
+    # Drop undated rows and sort by day with a single row index, applied once to every column
+    rows = np.flatnonzero(~np.isnat(days))
+    rows = rows[np.argsort(days[rows], kind="stable")]
+
+    dates = days[rows].astype(str).tolist()
+    sth = df[sth_col].to_numpy(dtype=np.float64)[rows]
+    price = df[price_col].to_numpy(dtype=np.float64)[rows] if price_col else np.full(len(rows), np.nan)
+
+    # 200-day moving average from BTC price (all NaN when there is no price column)
+    price_nan = np.isnan(price)
+    ma200, ma200_nan = _rolling_mean(price, price_nan, 200)
+
+    out = [
+        {"date": d, "sth_realized": s, "price": p, "ma200": m}
+        for d, s, p, m in zip(
+            dates,
+            _nullable(sth, np.isnan(sth)),
+            _nullable(price, price_nan),
+            _nullable(ma200, ma200_nan),
+        )
+    ]
 
+    payload = orjson.dumps(out, option=orjson.OPT_INDENT_2)
     OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    OUT_PATH.write_text(json.dumps(out, indent=2), encoding="utf-8")
-    print(f"Wrote {len(out)} rows to {OUT_PATH}")
+    OUT_PATH.write_bytes(payload)
+    # Compressed copy is uploaded as a workflow artifact, not committed; mtime=0 keeps it reproducible
+    OUT_GZ_PATH.write_bytes(gzip.compress(payload, compresslevel=6, mtime=0))
+    print(f"Wrote {len(out)} rows to {OUT_PATH} and {OUT_GZ_PATH}")
 
 
 if __name__ == "__main__":